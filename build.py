@@ -4,13 +4,23 @@ import zipfile
 import json
 import time
 import threading
-import queue
 import shutil
 import subprocess
 import multiprocessing
 import sys
 import os
-import urllib.request
+import http.client
+import concurrent.futures
+import selectors
+import struct
+import ctypes
+import hashlib
+import codecs
+import functools
+import collections
+import socket
+import argparse
+import re
 
 deps = [
   ('org.codehaus.jackson', 'jackson-core-asl', '1.9.13'),
@@ -25,6 +35,8 @@ testDeps = [
   ('junit', 'junit', '4.10')
   ]
   
+MAVEN_HOST = 'repo1.maven.org'
+
 LUCENE_VERSION = '6.2.0-SNAPSHOT'
 LUCENE_SERVER_VERSION = '0.1.0-SNAPSHOT'
 
@@ -46,24 +58,83 @@ luceneDeps = ('core',
 
 luceneTestDeps = ('test-framework',)
 
+# Build-time dependencies between the lucene modules above, so independent modules can be built
+# concurrently without two ant processes racing to build the same module:
+luceneModuleDeps = {
+  'core': (),
+  'analyzers-common': ('core',),
+  'analyzers-icu': ('analyzers-common',),
+  'facet': ('queries',),
+  'codecs': ('core',),
+  'grouping': ('queries',),
+  'highlighter': ('queries', 'join'),
+  'join': ('grouping',),
+  'misc': ('core',),
+  'queries': ('core',),
+  'queryparser': ('queries', 'sandbox'),
+  'suggest': ('analyzers-common', 'misc'),
+  'expressions': ('queries',),
+  'replicator': ('facet',),
+  'sandbox': ('core',),
+  'test-framework': ('codecs',),
+  }
+
 TEST_HEAP = '512m'
 
+# How many trailing lines of a failed command's output to show:
+RUN_OUTPUT_TAIL_LINES = 2000
+
+# inotify event masks, from linux/inotify.h:
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+
+# Per build target, the (sha1, size, mtime) of every source file as of the last successful build:
+MANIFEST_FILE_NAME = os.path.abspath('build/.manifest.json')
+
+JAVAC_ARGS_FILE_NAME = 'build/.javac.args'
+
+# See src/build/.../JavacDaemon.java:
+JAVAC_DAEMON_SOURCE_FILE_NAME = 'src/build/org/apache/lucene/server/build/JavacDaemon.java'
+JAVAC_DAEMON_CLASSES_DIR = 'build/classes/build'
+JAVAC_DAEMON_PORT_FILE_NAME = 'build/.javacd.port'
+JAVAC_DAEMON_LOG_FILE_NAME = 'build/.javacd.log'
+
 printLock = threading.Lock()
 
+manifest = None
+manifestDirty = False
+
+# True if --daemon was passed:
+useCompilerDaemon = False
+
+# each download thread's keep-alive connection to MAVEN_HOST:
+mavenConnections = threading.local()
+
+# lucene module lib directory -> the files in it:
+libDirCache = {}
+
 def message(s):
   with printLock:
     print(s)
 
+# escapes used in the events file's stdout/stderr chunks; add new ones here rather than chaining replaces:
+ESCAPES = {'%0A': '\n', '%09': '\t'}
+ESCAPES_RE = re.compile('|'.join(re.escape(x) for x in ESCAPES))
+
 def unescape(s):
-  return s.replace('%0A', '\n').replace('%09', '\t')
+  return ESCAPES_RE.sub(lambda m: ESCAPES[m.group()], s)
+
+class RunTestsJVM:
 
-class RunTestsJVM(threading.Thread):
+  # Tracks one test JVM; TestReactor feeds it events file contents and stdout bytes as they arrive
 
-  def __init__(self, id, jobs, classPath, verbose, seed, doPrintOutput, testMethod):
-    threading.Thread.__init__(self)
+  def __init__(self, id, jobs, classPathStr, verbose, seed, doPrintOutput, testMethod):
     self.id = id
     self.jobs = jobs
-    self.classPath = classPath
+    self.classPathStr = classPathStr
     self.verbose = verbose
     self.seed = seed
     self.testMethod = testMethod
@@ -71,12 +142,36 @@ class RunTestsJVM(threading.Thread):
     self.suiteCount = 0
     self.failCount = 0
     self.doPrintOutput = doPrintOutput
-
-  def run(self):
+    self.eventsFile = 'build/test/%d.events' % self.id
+    self.process = None
+    self.events = None
+    # tail of the JVM's stdout/stderr, shown if it dies; outputPartial is its unfinished last line:
+    self.output = collections.deque(maxlen=RUN_OUTPUT_TAIL_LINES)
+    self.outputPartial = b''
+    self.buffer = ''
+    self.decoder = json.JSONDecoder()
+
+    # False until the JVM reports its first IDLE event:
+    self.started = False
+
+    # True once all jobs finished:
+    self.done = False
+
+    # suites written to stdin that haven't finished yet; the first one is running:
+    self.inFlight = collections.deque()
+
+    # current suite and its state:
+    self.job = None
+    self.pendingOutput = []
+    self.didFail = False
+    self.testCaseFailed = False
+    self.testCaseName = None
+
+  def start(self):
     cmd = ['java']
     cmd.append('-Xmx%s' % TEST_HEAP)
     cmd.append('-cp')
-    cmd.append(':'.join(self.classPath))
+    cmd.append(self.classPathStr)
 
     if self.verbose:
       cmd.append('-Dtests.verbose=true')
@@ -95,179 +190,651 @@ class RunTestsJVM(threading.Thread):
     cmd.append('-esa')
     cmd.append('com.carrotsearch.ant.tasks.junit4.slave.SlaveMainSafe')
 
-    eventsFile = 'build/test/%d.events' % self.id
-    if os.path.exists(eventsFile):
-      os.remove(eventsFile)
+    if os.path.exists(self.eventsFile):
+      os.remove(self.eventsFile)
     cmd.append('-eventsfile')
-    cmd.append(eventsFile)
+    cmd.append(self.eventsFile)
 
     cmd.append('-flush')
     cmd.append('-stdin')
 
     #print('COMMAND: %s' % ' '.join(cmd))
 
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-    events = ReadEvents(p, eventsFile)
-    events.waitIdle()
+    self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
+    os.set_blocking(self.process.stdout.fileno(), False)
+
+  def openEvents(self):
+    # returns False if the JVM hasn't created its events file yet
+    try:
+      self.events = ReadEvents(self.eventsFile)
+    except FileNotFoundError:
+      return False
+    return True
+
+  def readEvents(self):
+    if self.events is not None:
+      self.feed(self.events.read())
+
+  def readOutput(self):
+    # returns False once the JVM has closed its stdout, i.e. exited
+    try:
+      b = os.read(self.process.stdout.fileno(), 65536)
+    except BlockingIOError:
+      return True
+    if len(b) == 0:
+      return False
+    lines = (self.outputPartial + b).split(b'\n')
+    self.outputPartial = lines.pop()
+    self.output.extend(line + b'\n' for line in lines)
+    return True
 
+  def finish(self):
+    # the JVM exited: consume any events it wrote before exiting
+    self.readEvents()
+    status = self.process.wait()
+    if not self.done:
+      raise RuntimeError('process exited with status %s:\n%s' % (status, (b''.join(self.output) + self.outputPartial).decode('utf-8', 'replace')))
+
+  def sendJobs(self):
+    # hand the JVM all of its suites at once; it runs them one by one, and closing stdin tells it to
+    # exit after the last one
+    self.process.stdin.write(''.join('%s\n' % job for job in self.jobs).encode('utf-8'))
+    self.process.stdin.close()
+    self.inFlight.extend(self.jobs)
+
+  def nextJob(self):
+    # called on each IDLE event, i.e. when the JVM is done with the previous suite (or with starting up)
+    if self.done:
+      return
+    elif self.job is None:
+      self.sendJobs()
+    else:
+      self.inFlight.popleft()
+
+    if len(self.inFlight) == 0:
+      self.job = None
+      self.done = True
+      return
+
+    job = self.inFlight[0]
+    self.job = job
+    self.suiteCount += 1
+    self.pendingOutput = []
+    self.didFail = False
+    self.testCaseFailed = False
+    self.testCaseName = None
+
+    message('%s...' % job[25:])
+
+  def feed(self, text):
+    # the events file is a stream of JSON arrays, each [eventType, details]; decode every complete
+    # one and keep any partial trailing event for next time
+    self.buffer += text
+    pos = 0
     while True:
-      job = self.jobs.get()
-      if job is None:
+      pos = self.buffer.find('[', pos)
+      if pos == -1:
+        pos = len(self.buffer)
+        break
+      try:
+        event, pos = self.decoder.raw_decode(self.buffer, pos)
+      except json.JSONDecodeError:
         break
+      self.handleEvent(event)
+    self.buffer = self.buffer[pos:]
+
+  def handleEvent(self, event):
+    if not self.started and event[0] != 'IDLE':
+      # skip the JVM's startup events
+      return
+    elif event[0] in ('APPEND_STDOUT', 'APPEND_STDERR'):
+      chunk = unescape(event[1]['chunk'])
+      if self.testCaseFailed or self.doPrintOutput:
+        message(chunk)
+      else:
+        self.pendingOutput.append(chunk)
+    elif event[0] in ('TEST_FAILURE', 'SUITE_FAILURE'):
+      details = event[1]['failure']
+      s = '\n!! %s.%s FAILED !!:\n\n' % (self.job[25:], self.testCaseName)
+      s += ''.join(self.pendingOutput)
+      if 'message' in details:
+        s += '\n%s\n' % details['message']
+      s += '\n%s' % details['trace']
+      message(s)
+      self.testCaseFailed = True
+      if not self.didFail:
+        self.failCount += 1
+        self.didFail = True
+    elif event[0] == 'TEST_STARTED':
+      self.testCount += 1
+      self.testCaseFailed = False
+      testCaseName = event[1]['description']
+      i = testCaseName.find('#')
+      j = testCaseName.find('(')
+      self.testCaseName = testCaseName[i+1:j]
+    elif event[0] == 'IDLE':
+      # the first IDLE means the JVM finished starting up
+      self.started = True
+      self.nextJob()
+
+class TestReactor:
+
+  # Single event loop driving all test JVMs: one selector over every JVM's stdout pipe plus one inotify fd
+  # watching all events files, instead of a polling thread per JVM
+
+  def __init__(self, jvms):
+    self.jvms = jvms
+    self.selector = selectors.DefaultSelector()
+    self.inotify = openInotify()
+    self.watches = {}
+    self.dirWatch = None
+    self.eventsFileNames = dict((os.path.basename(jvm.eventsFile), jvm) for jvm in jvms)
+
+  def openEvents(self, jvm):
+    if jvm.events is None and jvm.openEvents():
+      if self.inotify is not None:
+        self.watches[self.inotify.addWatch(jvm.eventsFile, IN_MODIFY | IN_CLOSE_WRITE)] = jvm
+      # events written before the watch was added:
+      jvm.readEvents()
 
-      self.suiteCount += 1
+  def run(self):
+    try:
+      if self.inotify is not None:
+        # watch for the JVMs creating their events files, instead of retrying open until they exist
+        self.dirWatch = self.inotify.addWatch(os.path.dirname(self.jvms[0].eventsFile), IN_CREATE | IN_MOVED_TO)
 
-      message('%s...' % job[25:])
+      for jvm in self.jvms:
+        jvm.start()
+        self.selector.register(jvm.process.stdout, selectors.EVENT_READ, jvm)
 
-      p.stdin.write((job + '\n').encode('utf-8'))
-      p.stdin.flush()
-      lines = []
+      # files created before we started watching:
+      for jvm in self.jvms:
+        self.openEvents(jvm)
 
-      pendingOutput = []
+      if self.inotify is not None:
+        self.selector.register(self.inotify, selectors.EVENT_READ, None)
+        timeout = None
+      else:
+        # no inotify: poll the events files
+        timeout = .01
+
+      running = set(self.jvms)
+      while len(running) > 0:
+        ready = self.selector.select(timeout)
+
+        if self.inotify is None:
+          for jvm in running:
+            self.openEvents(jvm)
+            jvm.readEvents()
+
+        for key, mask in ready:
+          if key.data is None:
+            changed = set()
+            for wd, mask, name in self.inotify.readEvents():
+              if wd == -1 or mask & IN_Q_OVERFLOW:
+                # the kernel dropped events, so we can't know which files changed: check every JVM
+                for jvm in running:
+                  self.openEvents(jvm)
+                  changed.add(jvm)
+              elif wd == self.dirWatch:
+                if name in self.eventsFileNames:
+                  self.openEvents(self.eventsFileNames[name])
+              elif wd in self.watches:
+                changed.add(self.watches[wd])
+            for jvm in changed:
+              if jvm in running:
+                jvm.readEvents()
+          else:
+            jvm = key.data
+            if not jvm.readOutput():
+              self.selector.unregister(jvm.process.stdout)
+              running.remove(jvm)
+              self.openEvents(jvm)
+              jvm.finish()
+    finally:
+      for jvm in self.jvms:
+        if jvm.process is not None and jvm.process.poll() is None:
+          jvm.process.kill()
+          jvm.process.wait()
+      self.selector.close()
+      if self.inotify is not None:
+        self.inotify.close()
+
+# Minimal ctypes wrapper around Linux's inotify API
+class Inotify:
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(None, use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd == -1:
+      e = ctypes.get_errno()
+      raise OSError(e, 'inotify_init1: %s' % os.strerror(e))
+
+  def fileno(self):
+    return self.fd
+
+  def addWatch(self, path, mask):
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd == -1:
+      e = ctypes.get_errno()
+      raise OSError(e, 'inotify_add_watch %s: %s' % (path, os.strerror(e)))
+    return wd
+
+  def readEvents(self):
+    # drains all pending events, returning a list of (wd, mask, name)
+    events = []
+    while True:
+      try:
+        b = os.read(self.fd, 65536)
+      except BlockingIOError:
+        break
+      upto = 0
+      while upto < len(b):
+        wd, mask, cookie, nameLen = struct.unpack_from('iIII', b, upto)
+        upto += 16
+        name = b[upto:upto+nameLen].rstrip(b'\0').decode('utf-8')
+        upto += nameLen
+        events.append((wd, mask, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+def openInotify():
+  # returns None if this platform has no inotify
+  try:
+    return Inotify()
+  except (AttributeError, OSError, TypeError):
+    return None
 
-      didFail = False
-      testCaseFailed = False
-      testCaseName = None
-      
-      while True:
-        l = events.readline()
-        l = l.rstrip()
-        if l == ']':
-          lines.append(l)
-          #print('DECODE:\n%s' % '\n'.join(lines))
-          if lines[1] == '[':
-            #print('  DO LOOK')
-            event = json.loads('\n'.join(lines))
-            if event[0] in ('APPEND_STDOUT', 'APPEND_STDERR'):
-              chunk = unescape(event[1]['chunk'])
-              if testCaseFailed or self.doPrintOutput:
-                message(chunk)
-              else:
-                pendingOutput.append(chunk)
-            elif event[0] in ('TEST_FAILURE', 'SUITE_FAILURE'):
-              details = event[1]['failure']
-              s = '\n!! %s.%s FAILED !!:\n\n' % (job[25:], testCaseName)
-              s += ''.join(pendingOutput)
-              if 'message' in details:
-                s += '\n%s\n' % details['message']
-              s += '\n%s' % details['trace']
-              message(s)
-              testCaseFailed = True
-              if not didFail:
-                self.failCount += 1
-                didFail = True
-            elif event[0] == 'TEST_STARTED':
-              self.testCount += 1
-              testCaseFailed = False
-              testCaseName = event[1]['description']
-              i = testCaseName.find('#')
-              j = testCaseName.find('(')
-              testCaseName = testCaseName[i+1:j]
-            elif event[0] == 'IDLE':
-              break
-          lines = []
-        else:
-          lines.append(l)
-        
 class ReadEvents:
 
-  def __init__(self, process, fileName):
-    self.process = process
+  # Non-blocking reader for a JVM's events file
+
+  def __init__(self, fileName):
     self.fileName = fileName
+    self.f = open(self.fileName, 'rb')
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+  def read(self):
+    # returns everything the JVM appended since the last read, holding back any split UTF-8 sequence
+    return self.decoder.decode(self.f.read())
+
+def mavenGet(path):
+  # GETs path from MAVEN_HOST, reusing this thread's connection; the caller must read the whole
+  # response before the next request
+  for attempt in range(2):
+    conn = getattr(mavenConnections, 'conn', None)
+    if conn is None:
+      conn = http.client.HTTPSConnection(MAVEN_HOST, timeout=30)
+      mavenConnections.conn = conn
+    try:
+      conn.request('GET', path)
+      response = conn.getresponse()
+    except (http.client.HTTPException, ConnectionError):
+      # the server may have closed our idle keep-alive connection: retry once on a new one
+      conn.close()
+      mavenConnections.conn = None
+      if attempt == 1:
+        raise
+      continue
+    if response.status != 200:
+      response.read()
+      raise RuntimeError('GET https://%s%s failed: %s %s' % (MAVEN_HOST, path, response.status, response.reason))
+    return response
+
+def fetchMavenJAR(org, name, version, destFileName):
+  path = '/maven2/%s/%s/%s/%s-%s.jar' % (org.replace('.', '/'), name, version, name, version)
+  message('Download https://%s%s -> %s...' % (MAVEN_HOST, path, destFileName))
+
+  # download to a temp file so a failed or corrupt download never leaves a truncated JAR behind
+  tmpFileName = destFileName + '.tmp'
+  h = hashlib.sha1()
+  response = mavenGet(path)
+  with open(tmpFileName, 'wb') as f:
     while True:
-      try:
-        self.f = open(self.fileName, 'rb')
-      except IOError:
-        time.sleep(.01)
-      else:
+      b = response.read(65536)
+      if len(b) == 0:
         break
-    self.f.seek(0)
-    
-  def readline(self):
-    while True:
-      pos = self.f.tell()
-      l = self.f.readline().decode('utf-8')
-      if l == '' or not l.endswith('\n'):
-        time.sleep(.01)
-        p = self.process.poll()
-        if p is not None:
-          raise RuntimeError('process exited with status %s' % str(p))
-        self.f.seek(pos)
-      else:
-        return l
+      h.update(b)
+      f.write(b)
 
-  def waitIdle(self):
-    lines = []
-    while True:
-      l = self.readline()
-      if l.find('"IDLE",') != -1:
-        return lines
-      else:
-        lines.append(l)
+  # the .sha1 file is sometimes followed by the file name:
+  expectedSHA1 = mavenGet(path + '.sha1').read().decode('ascii').split()[0].lower()
+  if h.hexdigest() != expectedSHA1:
+    os.remove(tmpFileName)
+    raise RuntimeError('SHA-1 mismatch downloading %s: got %s but expected %s' % (path, h.hexdigest(), expectedSHA1))
+  os.replace(tmpFileName, destFileName)
+
+  message('  done %s: %.1f KB' % (destFileName, os.path.getsize(destFileName)/1024.))
+
+def fetchMavenJARs(deps):
+  # download any missing JARs concurrently, so a cold ./lib costs max(download) instead of sum(download):
+  missing = []
+  for org, name, version in deps:
+    destFileName = 'lib/%s-%s.jar' % (name, version)
+    if not os.path.exists(destFileName):
+      missing.append((org, name, version, destFileName))
+
+  if len(missing) > 0:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+      futures = [executor.submit(fetchMavenJAR, *dep) for dep in missing]
+      for future in concurrent.futures.as_completed(futures):
+        # re-raises any download exception:
+        future.result()
+
+def run(command, cwd=None):
+  # command is either a shell command line, or an argv list run directly without a shell
+  p = subprocess.Popen(command, shell=isinstance(command, str), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True, cwd=cwd)
+
+  # only keep the tail of the output, so a long build log isn't held in memory just in case it fails:
+  tail = collections.deque(maxlen=RUN_OUTPUT_TAIL_LINES)
+  for line in p.stdout:
+    tail.append(line)
+  p.stdout.close()
+  p.wait()
 
-def fetchMavenJAR(org, name, version, destFileName):
-  url = 'http://central.maven.org/maven2/%s/%s/%s/%s-%s.jar' % (org.replace('.', '/'), name, version, name, version)
-  print('Download %s -> %s...' % (url, destFileName))
-  urllib.request.urlretrieve(url, destFileName)
-  print('  done: %.1f KB' % (os.path.getsize(destFileName)/1024.))
-
-def run(command):
-  p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, close_fds=True)
-  out, err = p.communicate()
   if p.returncode != 0:
-    print('\nERROR: command "%s" failed:\n%s' % (command, out.decode('utf-8')))
+    if not isinstance(command, str):
+      command = ' '.join(command)
+    message('\nERROR: command "%s" failed:\n%s' % (command, b''.join(tail).decode('utf-8', 'replace')))
     raise RuntimeError('command "%s" failed' % command)
 
+def loadManifest():
+  global manifest
+  if manifest is None:
+    if os.path.exists(MANIFEST_FILE_NAME):
+      with open(MANIFEST_FILE_NAME) as f:
+        manifest = json.load(f)
+    else:
+      manifest = {}
+  return manifest
+
+def saveManifest():
+  global manifestDirty
+  if manifestDirty:
+    os.makedirs(os.path.dirname(MANIFEST_FILE_NAME), exist_ok=True)
+    tmpFileName = MANIFEST_FILE_NAME + '.tmp'
+    with open(tmpFileName, 'w') as f:
+      json.dump(manifest, f)
+    os.replace(tmpFileName, MANIFEST_FILE_NAME)
+    manifestDirty = False
+
+def resetManifest():
+  # call after removing the build directory
+  global manifest, manifestDirty
+  manifest = None
+  manifestDirty = False
+  anyChangesSince.cache_clear()
+
+def sha1File(fileName):
+  h = hashlib.sha1()
+  with open(fileName, 'rb') as f:
+    while True:
+      b = f.read(65536)
+      if len(b) == 0:
+        break
+      h.update(b)
+  return h.hexdigest()
+
+def recordFile(entries, fileName, st):
+  global manifestDirty
+  entries[fileName] = [sha1File(fileName), st.st_size, st.st_mtime]
+  manifestDirty = True
+
+def isChanged(entries, fileName, st):
+  global manifestDirty
+  sha1, size, mtime = entries[fileName]
+  if st.st_mtime == mtime and st.st_size == size:
+    return False
+  if st.st_size != size or sha1File(fileName) != sha1:
+    return True
+  # only the mtime changed (e.g. git checkout): remember it so next time takes the fast path
+  entries[fileName][2] = st.st_mtime
+  manifestDirty = True
+  return False
+
+def walkFiles(srcDir):
+  # like os.walk, but yields each file's DirEntry so callers reuse its cached stat instead of stat'ing
+  # the path again
+  stack = [srcDir]
+  while len(stack) > 0:
+    with os.scandir(stack.pop()) as it:
+      for entry in it:
+        if entry.is_dir():
+          if not entry.is_symlink():
+            stack.append(entry.path)
+        else:
+          yield entry
+
+def recordBuild(srcDir, destJAR):
+  # snapshot all sources after successfully building destJAR from them
+  entries = {}
+  for entry in walkFiles(srcDir):
+    recordFile(entries, entry.path, entry.stat())
+  loadManifest()[destJAR] = entries
+  saveManifest()
+
 def anyChanges(srcDir, destJAR):
   if not os.path.exists(destJAR):
     return True
 
-  t1 = os.path.getmtime(destJAR)
-
-  for root, dirNames, fileNames in os.walk(srcDir):
-    for fileName in fileNames:
-      if os.path.getmtime('%s/%s' % (root, fileName)) > t1:
+  # the same JAR may be checked more than once per run (e.g. "test package"); only walk srcDir again
+  # if the JAR was rebuilt since:
+  return anyChangesSince(srcDir, destJAR, os.path.getmtime(destJAR))
+
+@functools.lru_cache(maxsize=None)
+def anyChangesSince(srcDir, destJAR, t1):
+  entries = loadManifest().setdefault(destJAR, {})
+
+  count = 0
+  newerThanJAR = False
+  for entry in walkFiles(srcDir):
+    st = entry.stat()
+    count += 1
+    if entry.path not in entries:
+      # not in the manifest yet: fall back to comparing mtime against the JAR
+      if st.st_mtime > t1:
         return True
+      recordFile(entries, entry.path, st)
+    elif isChanged(entries, entry.path, st):
+      return True
+    elif st.st_mtime > t1:
+      # touched, but same content
+      newerThanJAR = True
+
+  saveManifest()
+
+  if count != len(entries):
+    # a source file was removed
+    return True
+
+  if newerThanJAR:
+    # ant's uptodate checks only compare mtimes, so touch the JAR or every ant build that depends on
+    # it would rebuild it too, possibly several at once:
+    os.utime(destJAR)
 
   return False
 
+def getLuceneModulePaths(dep):
+  # returns (srcDir, destJAR)
+  if dep.startswith('analyzers-'):
+    # lucene analyzers have two level hierarchy!
+    part = dep[10:]
+    return ('lucene6x/lucene/analysis/%s' % part,
+            'lucene6x/lucene/build/analysis/%s/lucene-%s-%s.jar' % (part, dep, LUCENE_VERSION))
+  else:
+    return ('lucene6x/lucene/%s' % dep,
+            'lucene6x/lucene/build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION))
+
 def compileLuceneModules(deps):
-  os.chdir('lucene6x/lucene')
-  for dep in deps:
-    if dep.startswith('analyzers-'):
-      # lucene analyzers have two level hierarchy!
-      part = dep[10:]
-      if anyChanges('analysis/%s' % part, 'build/analysis/%s/lucene-%s-%s.jar' % (part, dep, LUCENE_VERSION)):
-        print('build lucene %s JAR...' % dep)
-        os.chdir('analysis/%s' % part)
-        run('ant jar')
-        os.chdir('../..')
-    elif anyChanges(dep, 'build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION)):
-      print('build lucene %s JAR...' % dep)
-      os.chdir(dep)
-      run('ant jar')
-      os.chdir('..')
-  os.chdir('../..')
+  # builds each changed module once all modules it depends on are built, running independent modules'
+  # ant builds concurrently; modules not in deps are assumed to be built already
+  pending = list(deps)
+  done = set()
+  running = {}
+  with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+    while len(pending) > 0 or len(running) > 0:
+      progress = False
+      for dep in list(pending):
+        if all(x in done or x not in deps for x in luceneModuleDeps.get(dep, ('core',))):
+          pending.remove(dep)
+          srcDir, destJAR = getLuceneModulePaths(dep)
+          if anyChanges(srcDir, destJAR):
+            message('build lucene %s JAR...' % dep)
+            running[executor.submit(run, 'ant jar', cwd=srcDir)] = dep
+          else:
+            done.add(dep)
+            progress = True
+
+      if progress:
+        # unchanged modules may have unblocked others
+        continue
+
+      if len(running) == 0:
+        raise RuntimeError('lucene module dependencies are circular: %s' % ', '.join(pending))
+
+      finished, unfinished = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in finished:
+        dep = running.pop(future)
+        # re-raises if ant failed:
+        future.result()
+        recordBuild(*getLuceneModulePaths(dep))
+        done.add(dep)
+
+class CompilerDaemon:
+
+  # Client for JavacDaemon, a javac server that outlives each ./build.py so incremental compiles skip
+  # javac's JVM startup; the first build to need it starts it, and later builds reuse it
+
+  def compile(self, args):
+    conn = self.connect()
+    if conn is None:
+      self.start()
+      conn = self.connect()
+      if conn is None:
+        raise RuntimeError('could not connect to javac daemon; see %s' % JAVAC_DAEMON_LOG_FILE_NAME)
+
+    with conn:
+      conn.sendall(('\n'.join(args) + '\n\n').encode('utf-8'))
+      chunks = []
+      while True:
+        b = conn.recv(65536)
+        if len(b) == 0:
+          break
+        chunks.append(b)
+
+    # javac's output, then a final DONE <status> line:
+    out = b''.join(chunks).decode('utf-8', 'replace').rstrip('\n')
+    i = out.rfind('\n')
+    status = out[i+1:]
+    if not status.startswith('DONE '):
+      raise RuntimeError('javac daemon failed:\n%s' % out)
+    if status != 'DONE 0':
+      message('\nERROR: command "javac %s" failed:\n%s' % (' '.join(args), out[:max(i, 0)]))
+      raise RuntimeError('command "javac %s" failed' % ' '.join(args))
+
+  def connect(self):
+    # returns None if no daemon is running; the port file holds the port and the daemon's secret token,
+    # which must be the first line of every request
+    try:
+      with open(JAVAC_DAEMON_PORT_FILE_NAME) as f:
+        port, token = f.read().split()
+      conn = socket.create_connection(('127.0.0.1', int(port)))
+    except (OSError, ValueError):
+      return None
+    conn.sendall(('%s\n' % token).encode('utf-8'))
+    return conn
+
+  def start(self):
+    classFileName = '%s/org/apache/lucene/server/build/JavacDaemon.class' % JAVAC_DAEMON_CLASSES_DIR
+    if not os.path.exists(classFileName) or os.path.getmtime(classFileName) < os.path.getmtime(JAVAC_DAEMON_SOURCE_FILE_NAME):
+      # javac won't create the -d directory itself
+      os.makedirs(JAVAC_DAEMON_CLASSES_DIR, exist_ok=True)
+      run(['javac', '-J-Xshare:auto', '-d', JAVAC_DAEMON_CLASSES_DIR, JAVAC_DAEMON_SOURCE_FILE_NAME])
+
+    if os.path.exists(JAVAC_DAEMON_PORT_FILE_NAME):
+      # stale: that daemon is gone
+      os.remove(JAVAC_DAEMON_PORT_FILE_NAME)
+
+    print('start javac daemon...')
+    with open(JAVAC_DAEMON_LOG_FILE_NAME, 'wb') as log:
+      p = subprocess.Popen(['java', '-Xshare:auto', '-cp', JAVAC_DAEMON_CLASSES_DIR, 'org.apache.lucene.server.build.JavacDaemon', JAVAC_DAEMON_PORT_FILE_NAME],
+                           stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+    t0 = time.time()
+    while not os.path.exists(JAVAC_DAEMON_PORT_FILE_NAME):
+      if p.poll() is not None:
+        raise RuntimeError('javac daemon exited with status %s; see %s' % (p.returncode, JAVAC_DAEMON_LOG_FILE_NAME))
+      if time.time() - t0 > 30:
+        raise RuntimeError('javac daemon did not start; see %s' % JAVAC_DAEMON_LOG_FILE_NAME)
+      time.sleep(.01)
+
+  def stop(self):
+    conn = self.connect()
+    if conn is not None:
+      with conn:
+        conn.sendall(b'SHUTDOWN\n')
+        # the daemon removes its port file before closing the connection, so wait for that before
+        # the caller deletes the build directory:
+        while len(conn.recv(65536)) > 0:
+          pass
 
 def compileChangedSources(srcPath, destPath, classPath):
+  entries = loadManifest().setdefault(destPath, {})
   changedSources = []
-  for root, dirNames, fileNames in os.walk(srcPath):
-    for fileName in fileNames:
-      if fileName.endswith('.java'):
-        classFileName = 'build/classes/%s.class' % ('%s/%s' % (root, fileName))[4:-5]
-        if not os.path.exists(classFileName) or os.path.getmtime(classFileName) < os.path.getmtime('%s/%s' % (root, fileName)):
-          changedSources.append('%s/%s' % (root, fileName))
+  for entry in walkFiles(srcPath):
+    if entry.name.endswith('.java'):
+      classFileName = 'build/classes/%s.class' % entry.path[4:-5]
+      try:
+        classMTime = os.stat(classFileName).st_mtime
+      except FileNotFoundError:
+        changedSources.append(entry.path)
+        continue
+      st = entry.stat()
+      if entry.path not in entries:
+        # not in the manifest yet: fall back to comparing mtime against the class file
+        if classMTime < st.st_mtime:
+          changedSources.append(entry.path)
+        else:
+          recordFile(entries, entry.path, st)
+      elif isChanged(entries, entry.path, st):
+        changedSources.append(entry.path)
 
   if len(changedSources) > 0:
-    cmd = ['javac', '-d', destPath]
-    cmd.append('-cp')
-    cmd.append(':'.join(classPath))
-    cmd.extend(changedSources)
+    # pass the sources via an @argfile: hundreds of changed files can overflow the command line
+    with open(JAVAC_ARGS_FILE_NAME, 'w') as f:
+      f.write('\n'.join(changedSources))
+    args = ['-d', destPath]
+    args.append('-cp')
+    args.append(':'.join(classPath))
+    args.append('@%s' % JAVAC_ARGS_FILE_NAME)
     print('compile sources:')
     for fileName in changedSources:
       print('  %s changed' % fileName)
-    run(' '.join(cmd))
+    if useCompilerDaemon:
+      CompilerDaemon().compile(args)
+    else:
+      run(['javac', '-J-Xshare:auto'] + args)
+    for fileName in changedSources:
+      recordFile(entries, fileName, os.stat(fileName))
+
+    # destPath's contents changed, so cached anyChanges answers may be stale:
+    anyChangesSince.cache_clear()
 
+  saveManifest()
+
+def listLibDir(libDir):
+  # lists a lucene module's third-party lib directory once per run; empty if it has none
+  if libDir not in libDirCache:
+    if os.path.isdir(libDir):
+      with os.scandir(libDir) as it:
+        libDirCache[libDir] = sorted(entry.path for entry in it)
+    else:
+      libDirCache[libDir] = []
+  return libDirCache[libDir]
+
+@functools.lru_cache(maxsize=1)
 def getCompileClassPath():
   l = []
   for org, name, version in deps:
@@ -279,13 +846,14 @@ def getCompileClassPath():
     else:
       l.append('lucene6x/lucene/build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION))
       libDir = 'lucene6x/lucene/%s/lib' % dep
-    if os.path.exists(libDir):
-      l.append('%s/*' % libDir)
+    # list the JARs explicitly instead of a libDir/* wildcard the JVM must expand each time:
+    l.extend(fileName for fileName in listLibDir(libDir) if fileName.lower().endswith('.jar'))
     
-  return l
+  return tuple(l)
 
+@functools.lru_cache(maxsize=1)
 def getTestClassPath():
-  l = getCompileClassPath()
+  l = list(getCompileClassPath())
   l.append('build/classes/java')
   for org, name, version in testDeps:
     l.append('lib/%s-%s.jar' % (name, version))
@@ -294,25 +862,23 @@ def getTestClassPath():
       l.append('lucene6x/lucene/build/analysis/%s/lucene-%s-%s.jar' % (dep[10:], dep, LUCENE_VERSION))
     else:
       l.append('lucene6x/lucene/build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION))
-  return l
-
-def getArg(option):
-  if option in sys.argv:
-    i = sys.argv.indexOf(option)
-    if i + 2 > len(sys.argv):
-      raise RuntimeError('command line option %s requires an argument' % option)
-    value = sys.argv[i+1]
-    del sys.argv[i:i+2]
-    return value
-  else:
-    return None
-
-def getFlag(option):
-  if option in sys.argv:
-    sys.argv.remove(option)
-    return True
+  return tuple(l)
+
+def iterTestClasses(classesDir):
+  # yields (className, path) for every top-level (not inner) Test* class file
+  for entry in walkFiles(classesDir):
+    name = entry.name
+    if name.startswith('Test') and name.endswith('.class') and '$' not in name:
+      yield entry.path[len(classesDir)+1:-6].replace('/', '.'), entry.path
+
+def addZipEntry(z, fileName, arcName):
+  # JARs are already deflated, so store them as-is and only deflate everything else
+  with open(fileName, 'rb') as f:
+    isZip = f.read(4) == b'PK\x03\x04'
+  if isZip:
+    z.write(fileName, arcName, compress_type=zipfile.ZIP_STORED)
   else:
-    return False
+    z.write(fileName, arcName, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
 
 def compileSourcesAndDeps():
   if not os.path.exists('lib'):
@@ -323,10 +889,7 @@ def compileSourcesAndDeps():
     os.makedirs('build/classes/java')
     os.makedirs('build/classes/test')
 
-  for dep in deps:
-    destFileName = 'lib/%s-%s.jar' % (dep[1], dep[2])
-    if not os.path.exists(destFileName):
-      fetchMavenJAR(*(dep + (destFileName,)))
+  fetchMavenJARs(deps)
 
   if not os.path.exists('lucene6x'):
     print('init: cloning lucene branch_6x to ./lucene6x...')
@@ -337,30 +900,87 @@ def compileSourcesAndDeps():
   # compile luceneserver sources
   jarFileName = 'build/luceneserver-%s.jar' % LUCENE_SERVER_VERSION
 
-  l = getCompileClassPath()
+  l = list(getCompileClassPath())
   l.append('build/classes/java')
   compileChangedSources('src/java', 'build/classes/java', l)
 
   if anyChanges('build/classes/java', jarFileName):
     print('build %s' % jarFileName)
     run('jar cf %s -C build/classes/java .' % jarFileName)
+    recordBuild('build/classes/java', jarFileName)
 
   return jarFileName
 
+TARGETS = ('clean', 'cleanlucene', 'package', 'test')
+
+USAGE = '''
+    Targets:
+
+      ./build.py clean
+
+        Removes all artifacts.
+
+      ./build.py test
+
+        Runs all tests.
+
+      ./build.py package
+
+        Build install zip to build/luceneserver-VERSION.zip
+
+      ./build.py TestFoo[.testBar]
+
+        Runs a single test class and optionally method.
+
+    You can also combine them, e.g. "clean test package".
+
+    Pass --daemon to compile through a background javac daemon that
+    stays up across builds, instead of running a fresh javac each time.
+     '''
+
+def parseArgs():
+  parser = argparse.ArgumentParser(usage='%(prog)s [options] target [target ...]',
+                                   epilog=USAGE,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('targets', nargs='+', metavar='target',
+                      help='one of %s, or TestFoo[.testBar]' % ', '.join(TARGETS))
+  parser.add_argument('-seed', '--seed', help='random seed for the tests')
+  parser.add_argument('-verbose', '--verbose', action='store_true', help='run tests with tests.verbose=true')
+  parser.add_argument('--daemon', action='store_true', help='compile through a background javac daemon')
+
+  if len(sys.argv) == 1:
+    parser.print_help()
+    sys.exit(1)
+
+  # intermixed, so options may come before or after the targets:
+  args = parser.parse_intermixed_args()
+
+  for i, what in enumerate(args.targets):
+    if what not in TARGETS and not what.startswith('Test') and (i == 0 or args.targets[i-1] != 'test'):
+      parser.error('unknown target %s' % what)
+
+  return args
+
 def main():
-  upto = 1
-  while upto < len(sys.argv):
-    what = sys.argv[upto]
+  global useCompilerDaemon
+
+  args = parseArgs()
+  useCompilerDaemon = args.daemon
+
+  targets = args.targets
+  upto = 0
+  while upto < len(targets):
+    what = targets[upto]
     upto += 1
     
     if what == 'clean':
       print('cleaning...')
+      CompilerDaemon().stop()
       if os.path.exists('build'):
         shutil.rmtree('build')
+      resetManifest()
     elif what == 'cleanlucene':
-      os.chdir('lucene6x')
-      run('ant clean')
-      os.chdir('..')
+      run('ant clean', cwd='lucene6x')
     elif what == 'package':
       
       jarFileName = compileSourcesAndDeps()
@@ -368,41 +988,48 @@ def main():
       destFileName = 'build/luceneserver-%s.zip' % LUCENE_SERVER_VERSION
       rootDirName = 'luceneserver-%s' % LUCENE_SERVER_VERSION
 
-      with zipfile.ZipFile(destFileName, 'w') as z:
-        z.write(jarFileName, '%s/lib/luceneserver-%s.jar' % (rootDirName, LUCENE_SERVER_VERSION))
+      with zipfile.ZipFile(destFileName, 'w', allowZip64=True) as z:
+        addZipEntry(z, jarFileName, '%s/lib/luceneserver-%s.jar' % (rootDirName, LUCENE_SERVER_VERSION))
         for org, name, version in deps:
-          z.write('lib/%s-%s.jar' % (name, version), '%s/lib/%s-%s.jar' % (rootDirName, name, version))
+          addZipEntry(z, 'lib/%s-%s.jar' % (name, version), '%s/lib/%s-%s.jar' % (rootDirName, name, version))
         for dep in luceneDeps:
           if dep.startswith('analyzers-'):
-            z.write('lucene6x/lucene/build/analysis/%s/lucene-%s-%s.jar' % (dep[10:], dep, LUCENE_VERSION), '%s/lib/lucene-%s-%s.jar' % (rootDirName, dep, LUCENE_VERSION))
+            addZipEntry(z, 'lucene6x/lucene/build/analysis/%s/lucene-%s-%s.jar' % (dep[10:], dep, LUCENE_VERSION), '%s/lib/lucene-%s-%s.jar' % (rootDirName, dep, LUCENE_VERSION))
             libDir = 'lucene6x/lucene/analysis/%s/lib' % dep[10:]
           else:
-            z.write('lucene6x/lucene/build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION), '%s/lib/lucene-%s-%s.jar' % (rootDirName, dep, LUCENE_VERSION))
+            addZipEntry(z, 'lucene6x/lucene/build/%s/lucene-%s-%s.jar' % (dep, dep, LUCENE_VERSION), '%s/lib/lucene-%s-%s.jar' % (rootDirName, dep, LUCENE_VERSION))
             libDir = 'lucene6x/lucene/%s/lib' % dep
-          if os.path.exists(libDir):
-            for name in os.listdir(libDir):
-              z.write('%s/%s' % (libDir, name), '%s/lib/%s' % (rootDirName, name))
+          for fileName in listLibDir(libDir):
+            addZipEntry(z, fileName, '%s/lib/%s' % (rootDirName, os.path.basename(fileName)))
 
-        print('\nWrote %s (%.1f MB)\n' % (destFileName, os.path.getsize(destFileName)/1024./1024.))
+      print('\nWrote %s (%.1f MB)\n' % (destFileName, os.path.getsize(destFileName)/1024./1024.))
 
     elif what == 'test' or what.startswith('Test'):
 
       if what.startswith('Test'):
-        upto -= 1
+        testSubString = what
+      elif upto < len(targets) and targets[upto] not in TARGETS:
+        testSubString = targets[upto]
+        upto += 1
+      else:
+        # Run all tests
+        testSubString = None
 
-      seed = getArg('-seed')
-      verbose = getFlag('-verbose')
+      testMethod = None
+      if testSubString is not None and '.' in testSubString:
+        parts = testSubString.split('.')
+        if len(parts) != 2:
+          raise RuntimeError('test fragment should be either TestFoo or TessFoo.testMethod')
+        testSubString = parts[0]
+        testMethod = parts[1]
 
       jarFileName = compileSourcesAndDeps()
 
       compileLuceneModules(luceneTestDeps)
 
-      for dep in testDeps:
-        destFileName = 'lib/%s-%s.jar' % (dep[1], dep[2])
-        if not os.path.exists(destFileName):
-          fetchMavenJAR(*(dep + (destFileName,)))
+      fetchMavenJARs(testDeps)
 
-      testCP = getTestClassPath()
+      testCP = list(getTestClassPath())
       testCP.append('build/classes/test')
       testCP.append(jarFileName)
       compileChangedSources('src/test', 'build/classes/test', testCP)
@@ -411,38 +1038,12 @@ def main():
           shutil.copy('src/test/org/apache/lucene/server/%s' % extraFile,
                       'build/classes/test/org/apache/lucene/server/%s' % extraFile)
 
-      if upto == len(sys.argv):
-        # Run all tests
-        testSubString = None
-        testMethod = None
-      elif upto == len(sys.argv)-1:
-        testSubString = sys.argv[upto]
-        if testSubString != 'package':
-          if '.' in testSubString:
-            parts = testSubString.split('.')
-            if len(parts) != 2:
-              raise RuntimeError('test fragment should be either TestFoo or TessFoo.testMethod')
-            testSubString = parts[0]
-            testMethod = parts[1]
-          else:
-            testMethod = None
-          upto += 1
-        else:
-          testSubString = None
-          testMethod = None
-      else:
-        raise RuntimeError('at most one test substring can be specified')
-
       testClasses = []
-      for root, dirNames, fileNames in os.walk('build/classes/test'):
-        for fileName in fileNames:
-          if fileName.startswith('Test') and fileName.endswith('.class') and '$' not in fileName:
-            fullPath = '%s/%s' % (root, fileName)
-            if testSubString is None or testSubString in fullPath:
-              className = fullPath[19:-6].replace('/', '.')
-              if testSubString is not None and len(testClasses) == 1:
-                raise RuntimeError('test name fragment "%s" is ambiguous, matching at least %s and %s' % (testSubString, testClasses[0], className))
-              testClasses.append(className)
+      for className, fullPath in iterTestClasses('build/classes/test'):
+        if testSubString is None or testSubString in fullPath:
+          if testSubString is not None and len(testClasses) == 1:
+            raise RuntimeError('test name fragment "%s" is ambiguous, matching at least %s and %s' % (testSubString, testClasses[0], className))
+          testClasses.append(className)
 
       if len(testClasses) == 0:
         if testSubString is None:
@@ -465,25 +1066,21 @@ def main():
         os.makedirs('build/test')
 
       t0 = time.time()
-      jobs = queue.Queue()
 
+      # deal the suites round-robin so each JVM gets a roughly equal share up front:
+      testClasses.sort()
+
+      testCPStr = ':'.join(testCP)
       jvms = []
       for i in range(jvmCount):
-        jvm = RunTestsJVM(0, jobs, testCP, verbose, None, printOutput, testMethod=testMethod)
-        jvm.start()
-        jvms.append(jvm)
+        jvms.append(RunTestsJVM(i, testClasses[i::jvmCount], testCPStr, args.verbose, args.seed, printOutput, testMethod=testMethod))
 
-      for s in testClasses:
-        jobs.put(s)
-
-      for i in range(jvmCount):
-        jobs.put(None)
+      TestReactor(jvms).run()
 
       failCount = 0
       testCount = 0
       suiteCount = 0
       for jvm in jvms:
-        jvm.join()
         failCount += jvm.failCount
         testCount += jvm.testCount
         suiteCount += jvm.suiteCount
@@ -495,36 +1092,12 @@ def main():
         sys.exit(1)
       elif testCount == 0:
         print('\nFAILURE: no tests ran!')
+        sys.exit(1)
       else:
         print('\nSUCCESS [%d test cases in %d suites in %.1f sec]' % (testCount, suiteCount, totalSec))
-        sys.exit(0)
       
     else:
       raise RuntimeError('unknown target %s' % what)
       
 if __name__ == '__main__':
-  if len(sys.argv) == 1:
-    print('''
-    Usage:
-
-      ./build.py clean
-
-        Removes all artifacts.
-
-      ./build.py test
-
-        Runs all tests.
-
-      ./build.py package
-
-        Build install zip to build/luceneserver-VERSION.zip
-
-      ./build.py TestFoo[.testBar]
-
-        Runs a single test class and optionally method.
-
-    You can also combine them, e.g. "clean test package".
-     ''')
-    sys.exit(1)
-    
   main()
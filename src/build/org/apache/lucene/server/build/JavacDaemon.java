@@ -0,0 +1,173 @@
+package org.apache.lucene.server.build;
+
+/*
+ * Licensed to the Apache Software Foundation (ASF) under one or more
+ * contributor license agreements.  See the NOTICE file distributed with
+ * this work for additional information regarding copyright ownership.
+ * The ASF licenses this file to You under the Apache License, Version 2.0
+ * (the "License"); you may not use this file except in compliance with
+ * the License.  You may obtain a copy of the License at
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.SocketTimeoutException;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.nio.file.attribute.PosixFilePermission;
+import java.nio.file.attribute.PosixFilePermissions;
+import java.security.MessageDigest;
+import java.security.SecureRandom;
+import java.util.ArrayList;
+import java.util.EnumSet;
+import java.util.List;
+
+import javax.tools.JavaCompiler;
+import javax.tools.ToolProvider;
+
+/** Long-lived javac server used by build.py, so incremental
+ *  compiles don't pay JVM and javac startup on every build.
+ *
+ *  <p>Listens on a loopback port, and writes that port plus a random
+ *  token, one per line, to the file passed as its only argument; the
+ *  file is readable only by its owner.  Each connection sends the
+ *  token on the first line, then one javac argument per line followed
+ *  by an empty line, and gets back javac's output followed by a final
+ *  "DONE &lt;status&gt;" line.  Connections with the wrong token are
+ *  closed without compiling, since javac arguments such as -processor
+ *  run arbitrary code.  Sending "SHUTDOWN" after the token stops the
+ *  daemon, as does an hour without any requests. */
+public class JavacDaemon {
+
+  private static final int IDLE_TIMEOUT_MSEC = 60*60*1000;
+
+  public static void main(String[] args) throws Exception {
+    if (args.length != 1) {
+      System.err.println("Usage: java org.apache.lucene.server.build.JavacDaemon portFile");
+      System.exit(1);
+    }
+
+    JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+    if (compiler == null) {
+      throw new IllegalStateException("no system Java compiler: the javac daemon must run on a JDK, not a JRE");
+    }
+
+    byte[] tokenBytes = new byte[32];
+    new SecureRandom().nextBytes(tokenBytes);
+    StringBuilder sb = new StringBuilder();
+    for (byte b : tokenBytes) {
+      sb.append(String.format("%02x", b & 0xff));
+    }
+    String token = sb.toString();
+
+    Path portFile = Paths.get(args[0]);
+    try (ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress())) {
+      server.setSoTimeout(IDLE_TIMEOUT_MSEC);
+      String contents = server.getLocalPort() + "\n" + token + "\n";
+
+      // Publish the port and token atomically so clients never see a
+      // partial file, creating it owner-only before the token is written:
+      Path tmpFile = portFile.resolveSibling(portFile.getFileName() + ".tmp");
+      Files.deleteIfExists(tmpFile);
+      Files.createFile(tmpFile, PosixFilePermissions.asFileAttribute(EnumSet.of(PosixFilePermission.OWNER_READ,
+                                                                                PosixFilePermission.OWNER_WRITE)));
+      Files.write(tmpFile, contents.getBytes(StandardCharsets.UTF_8));
+      Files.move(tmpFile, portFile, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+
+      try {
+        while (true) {
+          Socket socket;
+          try {
+            socket = server.accept();
+          } catch (SocketTimeoutException ste) {
+            // Idle for too long
+            break;
+          }
+          try (Socket s = socket) {
+            if (handle(compiler, token, portFile, contents, s) == false) {
+              break;
+            }
+          } catch (IOException ioe) {
+            // Client went away; keep serving others
+          }
+        }
+      } finally {
+        deletePortFile(portFile, contents);
+      }
+    }
+  }
+
+  /** Removes the port file, unless a newer daemon has
+   *  already replaced it. */
+  private static void deletePortFile(Path portFile, String contents) {
+    try {
+      if (contents.equals(new String(Files.readAllBytes(portFile), StandardCharsets.UTF_8))) {
+        Files.delete(portFile);
+      }
+    } catch (IOException ioe) {
+      // Already gone
+    }
+  }
+
+  /** Runs one compile request; returns false if the client
+   *  asked us to shut down. */
+  private static boolean handle(JavaCompiler compiler, String token, Path portFile, String contents, Socket socket) throws IOException {
+    BufferedReader in = new BufferedReader(new InputStreamReader(socket.getInputStream(), StandardCharsets.UTF_8));
+
+    String clientToken = in.readLine();
+    if (clientToken == null || MessageDigest.isEqual(token.getBytes(StandardCharsets.UTF_8),
+                                                     clientToken.getBytes(StandardCharsets.UTF_8)) == false) {
+      // Not from a build.py run by our user: drop it without compiling
+      return true;
+    }
+
+    List<String> compilerArgs = new ArrayList<>();
+    while (true) {
+      String line = in.readLine();
+      if (line == null || line.isEmpty()) {
+        break;
+      }
+      if (line.equals("SHUTDOWN")) {
+        // Delete the port file while the client is still
+        // connected: it waits for us to close the connection
+        // before e.g. removing the build directory:
+        deletePortFile(portFile, contents);
+        return false;
+      }
+      compilerArgs.add(line);
+    }
+
+    ByteArrayOutputStream output = new ByteArrayOutputStream();
+    int status;
+    try {
+      status = compiler.run(null, output, output, compilerArgs.toArray(new String[compilerArgs.size()]));
+    } catch (Throwable t) {
+      t.printStackTrace(new PrintStream(output, true, "UTF-8"));
+      status = -1;
+    }
+
+    OutputStream out = socket.getOutputStream();
+    output.writeTo(out);
+    out.write(("\nDONE " + status + "\n").getBytes(StandardCharsets.UTF_8));
+    out.flush();
+    return true;
+  }
+}